@@ -1,62 +1,207 @@
 import os
+import re
+import time
+import asyncio
 import hashlib
 import logging
 from datetime import datetime, timezone
+from enum import Enum
 from typing import Optional
 
 import asyncpg
-from fastapi import Request, HTTPException
+from fastapi import Request, HTTPException, Depends
 
 logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 API_KEY_PREFIX = "waro_"
 
+# Formato esperado de credenciales; lo que no encaja se rechaza sin tocar cache ni BD
+_API_KEY_RE = re.compile(rf"{API_KEY_PREFIX}[A-Za-z0-9_\-]{{20,200}}")
+_SESSION_TOKEN_RE = re.compile(r"[0-9a-fA-F]{8}-?(?:[0-9a-fA-F]{4}-?){3}[0-9a-fA-F]{12}")
+
+# Postgres max_connections debe superar DB_POOL_MAX x número de réplicas
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "25"))
+
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_MAX_SIZE = 10_000
+LAST_USED_FLUSH_INTERVAL = 5
+
 _pool: Optional[asyncpg.Pool] = None
+_flush_task: Optional[asyncio.Task] = None
+
+# token_ids pendientes de actualizar last_used_at
+_pending_last_used: set[str] = set()
+
+# SQL fijo: asyncpg cachea el statement preparado por texto en cada conexión
+# Tokens inactivos o expirados se descartan en la BD (ver migrations/)
+SQL_VALIDATE_API_KEY = """
+    SELECT id, tenant_id, scopes, expires_at
+    FROM api_tokens
+    WHERE key_hash = $1
+      AND is_active
+      AND (expires_at IS NULL OR expires_at > NOW())
+"""
+
+SQL_VALIDATE_SESSION = """
+    SELECT id, user_id, tenant_id
+    FROM sessions
+    WHERE id = $1::uuid
+      AND is_active
+      AND (expires_at IS NULL OR expires_at > NOW())
+"""
+
+# api_key -> (expiry monotonic, token dict); los hits no necesitan calcular el hash
+_token_cache: dict[str, tuple[float, dict]] = {}
 
 
 async def get_pool() -> asyncpg.Pool:
-    global _pool
+    global _pool, _flush_task
     if _pool is None:
-        _pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+        _pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            max_inactive_connection_lifetime=300,
+            command_timeout=10,
+            init=_init_connection,
+        )
+    if _flush_task is None:
+        _flush_task = asyncio.create_task(_flush_last_used_loop())
     return _pool
 
 
+async def _init_connection(conn: asyncpg.Connection):
+    # UUIDs como str directamente desde el driver, sin str() por campo
+    await conn.set_type_codec(
+        "uuid", encoder=str, decoder=str, schema="pg_catalog", format="text"
+    )
+
+
+def pool_ready() -> bool:
+    return _pool is not None
+
+
 async def close_pool():
-    global _pool
+    global _pool, _flush_task
+    if _flush_task:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
     if _pool:
+        await _flush_last_used()
         await _pool.close()
         _pool = None
 
 
+async def _flush_last_used():
+    """Actualiza last_used_at de todos los tokens pendientes en un solo UPDATE."""
+    global _pending_last_used
+    if not _pending_last_used or _pool is None:
+        return
+
+    batch, _pending_last_used = _pending_last_used, set()
+    try:
+        await _pool.execute(
+            "UPDATE api_tokens SET last_used_at = NOW() WHERE id = ANY($1::uuid[])",
+            list(batch),
+        )
+    except Exception as e:
+        logger.warning(f"Error actualizando last_used_at: {e}")
+        _pending_last_used |= batch
+    except BaseException:
+        # Cancelado (p.ej. en close_pool): el lote se reintenta en el drain final
+        _pending_last_used |= batch
+        raise
+
+
+async def _flush_last_used_loop():
+    while True:
+        await asyncio.sleep(LAST_USED_FLUSH_INTERVAL)
+        await _flush_last_used()
+
+
 def hash_api_key(api_key: str) -> str:
     return hashlib.sha256(api_key.encode()).hexdigest()
 
 
-def extract_api_key(request: Request) -> Optional[str]:
-    """Extrae API key de Authorization: Bearer o X-API-Key."""
-    auth_header = request.headers.get("authorization", "")
-    if auth_header.startswith("Bearer ") and auth_header[7:].startswith(API_KEY_PREFIX):
-        return auth_header[7:]
+def _get_cached_token(api_key: str) -> Optional[dict]:
+    entry = _token_cache.get(api_key)
+    if entry is None:
+        return None
+    expiry, result = entry
+    if time.monotonic() >= expiry:
+        _token_cache.pop(api_key, None)
+        return None
+    return result
 
-    api_key_header = request.headers.get("x-api-key", "")
-    if api_key_header.startswith(API_KEY_PREFIX):
-        return api_key_header
 
-    return None
+def _cache_token(api_key: str, result: dict, expires_at: Optional[datetime]):
+    """Guarda el token validado; el TTL nunca supera la expiración del token."""
+    ttl = TOKEN_CACHE_TTL
+    if expires_at:
+        ttl = min(ttl, (expires_at - datetime.now(timezone.utc)).total_seconds())
+    if ttl <= 0:
+        return
 
+    if len(_token_cache) >= TOKEN_CACHE_MAX_SIZE:
+        now = time.monotonic()
+        for k in [k for k, (exp, _) in _token_cache.items() if exp <= now]:
+            del _token_cache[k]
+        if len(_token_cache) >= TOKEN_CACHE_MAX_SIZE:
+            # dict conserva orden de inserción: descarta la entrada más antigua
+            del _token_cache[next(iter(_token_cache))]
 
-def extract_session_token(request: Request) -> Optional[str]:
-    """Extrae session token de Authorization: Bearer (non-waro prefix) o cookie."""
+    _token_cache[api_key] = (time.monotonic() + ttl, result)
+
+
+class Credential(str, Enum):
+    API_KEY = "api_key"
+    SESSION = "session"
+    NONE = "none"
+
+
+def _classify_credential(request: Request) -> tuple[Credential, Optional[str]]:
+    """Lee Authorization una sola vez y devuelve (tipo, credencial).
+
+    Prioridad: API key (Bearer o X-API-Key), luego session token
+    (Bearer sin prefijo waro o cookie).
+    """
+    bearer = None
     auth_header = request.headers.get("authorization", "")
-    if auth_header.startswith("Bearer ") and not auth_header[7:].startswith(API_KEY_PREFIX):
-        return auth_header[7:]
+    if auth_header.startswith("Bearer "):
+        bearer = auth_header[7:]
+        if bearer.startswith(API_KEY_PREFIX):
+            return Credential.API_KEY, bearer
+
+    api_key_header = request.headers.get("x-api-key", "")
+    if api_key_header.startswith(API_KEY_PREFIX):
+        return Credential.API_KEY, api_key_header
+
+    if bearer:
+        return Credential.SESSION, bearer
 
     session_token = request.cookies.get("session-token")
     if session_token:
-        return session_token
+        return Credential.SESSION, session_token
+
+    return Credential.NONE, None
+
+
+def extract_api_key(request: Request) -> Optional[str]:
+    """Extrae API key de Authorization: Bearer o X-API-Key."""
+    kind, credential = _classify_credential(request)
+    return credential if kind == Credential.API_KEY else None
+
 
-    return None
+def extract_session_token(request: Request) -> Optional[str]:
+    """Extrae session token de Authorization: Bearer (non-waro prefix) o cookie."""
+    kind, credential = _classify_credential(request)
+    return credential if kind == Credential.SESSION else None
 
 
 async def validate_api_key(api_key: str) -> Optional[dict]:
@@ -64,38 +209,26 @@ async def validate_api_key(api_key: str) -> Optional[dict]:
     if not api_key or not api_key.startswith(API_KEY_PREFIX):
         return None
 
+    cached = _get_cached_token(api_key)
+    if cached is not None:
+        _pending_last_used.add(cached["token_id"])
+        return cached
+
     key_hash = hash_api_key(api_key)
     pool = await get_pool()
+    token = await pool.fetchrow(SQL_VALIDATE_API_KEY, key_hash)
 
-    async with pool.acquire() as conn:
-        token = await conn.fetchrow(
-            """
-            SELECT id, tenant_id, scopes, expires_at, is_active
-            FROM api_tokens
-            WHERE key_hash = $1
-            """,
-            key_hash,
-        )
-
-        if not token:
-            return None
-
-        if not token["is_active"]:
-            return None
-
-        if token["expires_at"] and token["expires_at"] < datetime.now(timezone.utc):
-            return None
-
-        await conn.execute(
-            "UPDATE api_tokens SET last_used_at = NOW() WHERE id = $1",
-            token["id"],
-        )
+    if not token:
+        return None
 
-        return {
-            "token_id": str(token["id"]),
-            "tenant_id": str(token["tenant_id"]),
-            "scopes": token["scopes"],
-        }
+    result = {
+        "token_id": token["id"],
+        "tenant_id": token["tenant_id"],
+        "scopes": token["scopes"],
+    }
+    _cache_token(api_key, result, token["expires_at"])
+    _pending_last_used.add(result["token_id"])
+    return result
 
 
 async def validate_session_token(session_token: str) -> Optional[dict]:
@@ -104,52 +237,54 @@ async def validate_session_token(session_token: str) -> Optional[dict]:
         return None
 
     pool = await get_pool()
+    session = await pool.fetchrow(SQL_VALIDATE_SESSION, session_token)
 
-    async with pool.acquire() as conn:
-        session = await conn.fetchrow(
-            """
-            SELECT id, user_id, tenant_id, expires_at, is_active
-            FROM sessions
-            WHERE id = $1::uuid
-            """,
-            session_token,
-        )
-
-        if not session:
-            return None
-
-        if not session["is_active"]:
-            return None
-
-        if session["expires_at"] and session["expires_at"] < datetime.now(timezone.utc):
-            return None
-
-        return {
-            "session_id": str(session["id"]),
-            "user_id": str(session["user_id"]),
-            "tenant_id": str(session["tenant_id"]),
-        }
-
+    if not session:
+        return None
 
-async def require_auth(request: Request) -> dict:
-    """Dependency: requiere API key o session token válido."""
-    # Try API key first
-    api_key = extract_api_key(request)
-    if api_key:
-        result = await validate_api_key(api_key)
-        if result:
-            return result
-        raise HTTPException(status_code=401, detail="Invalid or expired API key")
-
-    # Try session token
-    session_token = extract_session_token(request)
-    if session_token:
-        result = await validate_session_token(session_token)
-        if result:
-            return result
-        raise HTTPException(status_code=401, detail="Invalid or expired session")
+    return {
+        "session_id": session["id"],
+        "user_id": session["user_id"],
+        "tenant_id": session["tenant_id"],
+    }
+
+
+async def extract_credentials(request: Request) -> tuple[Credential, Optional[str]]:
+    """Dependency: clasifica la credencial de la petición.
+
+    async aunque no haga I/O: FastAPI ejecuta las dependencias sync en el threadpool.
+    """
+    return _classify_credential(request)
+
+
+async def validate_credentials(
+    credentials: tuple[Credential, Optional[str]] = Depends(extract_credentials),
+) -> dict:
+    """Dependency: valida la credencial; FastAPI la cachea por petición."""
+    kind, credential = credentials
+
+    match kind:
+        case Credential.API_KEY:
+            if not _API_KEY_RE.fullmatch(credential):
+                raise HTTPException(status_code=401, detail="Invalid or expired API key")
+            result = await validate_api_key(credential)
+            if result:
+                return result
+            raise HTTPException(status_code=401, detail="Invalid or expired API key")
+        case Credential.SESSION:
+            if not _SESSION_TOKEN_RE.fullmatch(credential):
+                raise HTTPException(status_code=401, detail="Invalid or expired session")
+            result = await validate_session_token(credential)
+            if result:
+                return result
+            raise HTTPException(status_code=401, detail="Invalid or expired session")
 
     raise HTTPException(
         status_code=401,
         detail="Authentication required. Use Authorization: Bearer <session_token> or API key"
     )
+
+
+async def require_auth(auth: dict = Depends(validate_credentials)) -> dict:
+    """Dependency: requiere API key o session token válido."""
+    return auth
@@ -1,93 +1,437 @@
 import os
 import json
+import time
+import asyncio
+import hashlib
 import httpx
+import orjson
+import fastjsonschema
 from fastapi import FastAPI, HTTPException, Depends, Request
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from typing import AsyncIterator, Callable, Optional
 
-from auth import require_auth, get_pool, close_pool
+from auth import require_auth, get_pool, close_pool, pool_ready
 
-app = FastAPI(title="Ollama Extract API")
+
+class JSONResponse(ORJSONResponse):
+    """ORJSONResponse con fallback a json para enteros de más de 64 bits
+    (p.ej. IDs numéricos largos extraídos de una factura)."""
+
+    def render(self, content) -> bytes:
+        try:
+            return super().render(content)
+        except orjson.JSONEncodeError:
+            return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+app = FastAPI(title="Ollama Extract API", default_response_class=JSONResponse)
 
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434")
 MODEL_NAME = os.getenv("MODEL_NAME", "qwen2.5:1.5b")
 
+# Cliente compartido: mantiene conexiones keep-alive hacia Ollama
+_http_client: Optional[httpx.AsyncClient] = None
+
+EXTRACT_SYSTEM_PROMPT = "Eres un extractor de datos de facturas. Responde SOLO con JSON válido."
+EXTRACT_PROMPT_TEMPLATE = """{instructions}
+
+Ahora extrae los datos del siguiente texto OCR:
+\"\"\"
+{text}
+\"\"\""""
+
+PULL_RETRY_INITIAL_DELAY = 1
+PULL_RETRY_MAX_DELAY = 60
+
+MAX_TEXT_LEN = int(os.getenv("MAX_TEXT_LEN", "50000"))
+
+EXTRACT_CACHE_TTL = int(os.getenv("EXTRACT_CACHE_TTL", "3600"))
+EXTRACT_CACHE_MAX_SIZE = 1000
+
+# sha256(request) -> (expiry monotonic, parsed data)
+_extract_cache: dict[str, tuple[float, dict]] = {}
+
+VALIDATOR_CACHE_MAX_SIZE = 256
+
+# sha256(schema) -> validador compilado (None si el JSON Schema no compila)
+_validator_cache: dict[bytes, Optional[Callable]] = {}
+
+# sha256(request) -> tarea en curso; peticiones idénticas concurrentes comparten la inferencia
+_inflight: dict[str, asyncio.Task] = {}
+
 
 class ExtractRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     text: str
-    schema_json: dict
+    # Field() explícito: el nombre choca con BaseModel.schema_json y sin él
+    # pydantic toma el método como default y el campo deja de ser requerido
+    schema_json: dict = Field()
     instructions: str = ""
 
 
 class ChatRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     message: str
     system: str = ""
+    stream: bool = False
+
+
+def _dumps(obj, sort_keys: bool = False) -> bytes:
+    """orjson.dumps con fallback a json para valores que orjson no admite
+    (p.ej. enteros de más de 64 bits en un schema)."""
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+    except orjson.JSONEncodeError:
+        return json.dumps(
+            obj, sort_keys=sort_keys, ensure_ascii=False, separators=(",", ":")
+        ).encode()
+
+
+def _json_body(model: type[BaseModel]) -> dict:
+    """openapi_extra para endpoints que validan el body con model_validate_json."""
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": model.model_json_schema()}},
+        }
+    }
+
+
+def _is_json_content_type(content_type: str) -> bool:
+    # Guard de FastAPI contra CVE-2021-32677, más estricto: también se exige
+    # el header (un Blob sin tipo en fetch cross-site lo omite)
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    maintype, _, subtype = media_type.partition("/")
+    return maintype == "application" and (subtype == "json" or subtype.endswith("+json"))
+
+
+async def _parse_body(request: Request, model: type[BaseModel]):
+    # Evita que un form POST cross-site con la cookie de sesión pase como JSON
+    if not _is_json_content_type(request.headers.get("content-type", "")):
+        raise HTTPException(status_code=415, detail="Content-Type must be application/json")
+
+    # Valida directamente los bytes: evita json.loads a dict + validación aparte
+    try:
+        return model.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+        )
+
+
+async def extract_body(request: Request) -> ExtractRequest:
+    return await _parse_body(request, ExtractRequest)
+
+
+async def chat_body(request: Request) -> ChatRequest:
+    return await _parse_body(request, ChatRequest)
 
 
 @app.on_event("startup")
 async def startup():
-    """Descarga el modelo e inicializa DB pool."""
+    """Inicializa DB pool y cliente HTTP; la descarga del modelo sigue en segundo plano."""
+    global _http_client
+    _http_client = httpx.AsyncClient(
+        timeout=120,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    )
+    app.state.model_ready = False
+    app.state.pull_task = asyncio.create_task(_pull_model())
     await get_pool()
-    async with httpx.AsyncClient(timeout=600) as client:
+
+
+async def _pull_model():
+    """Descarga el modelo reintentando con backoff hasta lograrlo o hasta el shutdown.
+
+    depends_on no espera a que Ollama acepte conexiones, así que en un
+    arranque en frío los primeros intentos suelen fallar.
+    """
+    delay = PULL_RETRY_INITIAL_DELAY
+    while True:
         try:
-            res = await client.post(
+            res = await _http_client.post(
                 f"{OLLAMA_URL}/api/pull",
                 json={"name": MODEL_NAME, "stream": False},
+                timeout=600,
             )
             print(f"Modelo {MODEL_NAME}: {res.status_code}")
+            if res.is_success:
+                app.state.model_ready = True
+                return
         except Exception as e:
             print(f"Error descargando modelo: {e}")
 
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, PULL_RETRY_MAX_DELAY)
+
 
 @app.on_event("shutdown")
 async def shutdown():
+    global _http_client
+    if not app.state.pull_task.done():
+        app.state.pull_task.cancel()
+    if _http_client:
+        await _http_client.aclose()
+        _http_client = None
     await close_pool()
 
 
 @app.get("/health")
 async def health():
-    return {"status": "ok", "model": MODEL_NAME}
+    return {
+        "status": "ok",
+        "model": MODEL_NAME,
+        "db": pool_ready(),
+        "model_ready": app.state.model_ready,
+    }
 
 
-@app.post("/extract")
-async def extract(req: ExtractRequest, auth: dict = Depends(require_auth)):
+@app.post("/extract", openapi_extra=_json_body(ExtractRequest))
+async def extract(auth: dict = Depends(require_auth), req: ExtractRequest = Depends(extract_body)):
     """Extrae datos de un texto y devuelve JSON estructurado.
 
     Uses Ollama's native structured outputs (format parameter) to guarantee
     valid JSON matching the provided schema at the token/grammar level.
     """
-    prompt = f"""{req.instructions}
+    # Validaciones baratas antes de gastar una inferencia
+    _check_text(req.text, "text")
+    # En schemas simplificados "type" puede ser un campo de datos más
+    if _is_json_schema(req.schema_json) and not _is_object_root(req.schema_json):
+        raise HTTPException(status_code=400, detail="schema_json root must be an object")
 
-Ahora extrae los datos del siguiente texto OCR:
-\"\"\"
-{req.text}
-\"\"\""""
+    # Serialización canónica + hash del schema una sola vez por petición
+    schema_digest = _schema_digest(req.schema_json)
+
+    # Se compila antes de la inferencia: un $ref remoto se rechaza con 400
+    validator = await _get_validator(schema_digest, req.schema_json)
+
+    cache_key = _extract_cache_key(req, schema_digest)
+    cached = _get_cached_extract(cache_key)
+    if cached is not None:
+        return {"success": True, "data": cached, "tenant_id": auth["tenant_id"]}
+
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(_run_extract(req, cache_key, validator))
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda t: _finish_inflight(cache_key, t))
+
+    # shield: si un cliente se desconecta no cancela la inferencia de los demás
+    parsed, result = await asyncio.shield(task)
+    if parsed is None:
+        return {"success": False, "data": None, "raw": result}
+
+    return {"success": True, "data": parsed, "tenant_id": auth["tenant_id"]}
+
+
+def _is_object_root(schema: dict) -> bool:
+    root_type = schema.get("type", "object")
+    if isinstance(root_type, list):
+        # p.ej. ["object", "null"]
+        return "object" in root_type
+    return root_type == "object"
+
+
+def _check_text(value: str, field: str):
+    if not value.strip():
+        raise HTTPException(status_code=400, detail=f"{field} must not be empty")
+    if len(value) > MAX_TEXT_LEN:
+        raise HTTPException(status_code=400, detail=f"{field} exceeds {MAX_TEXT_LEN} characters")
+
+
+async def _run_extract(req: ExtractRequest, cache_key: str, validator: Optional[Callable]):
+    prompt = EXTRACT_PROMPT_TEMPLATE.format(instructions=req.instructions, text=req.text)
 
     result = await _chat_structured(
         message=prompt,
-        system="Eres un extractor de datos de facturas. Responde SOLO con JSON válido.",
+        system=EXTRACT_SYSTEM_PROMPT,
         format_schema=req.schema_json,
     )
 
+    if req.schema_json:
+        # Ollama ya restringe la gramática con format: no hace falta el fallback
+        try:
+            parsed = json.loads(result)
+        except json.JSONDecodeError:
+            return None, result
+    else:
+        parsed = _parse_json_result(result)
+
+    if parsed is None or not _matches_schema(validator, parsed):
+        return None, result
+
+    _cache_extract(cache_key, parsed)
+    return parsed, result
+
+
+def _is_json_schema(schema: dict) -> bool:
+    """Distingue un JSON Schema real de un schema simplificado {"campo": "tipo"}.
+
+    En los simplificados las claves son nombres de campo, que pueden
+    coincidir con keywords (type, required, ...); solo se consideran JSON
+    Schema los que declaran $schema o un objeto properties.
+    """
+    return "$schema" in schema or isinstance(schema.get("properties"), dict)
+
+
+class RemoteRefError(fastjsonschema.JsonSchemaDefinitionException):
+    pass
+
+
+def _refuse_remote_ref(uri: str):
+    raise RemoteRefError(f"Remote $ref not allowed: {uri}")
+
+
+# fastjsonschema descarga con urlopen los esquemas sin handler: se bloquean todos.
+# $id absolutos y refs locales ("#/...") se resuelven sin red.
+_REF_HANDLERS = {scheme: _refuse_remote_ref for scheme in ("", "http", "https", "ftp", "file", "data")}
+
+
+async def _get_validator(schema_digest: bytes, schema: dict) -> Optional[Callable]:
+    """Validador compilado para schema, o None si no es un JSON Schema válido.
+
+    Lanza HTTPException 400 si el schema necesita resolver un $ref remoto.
+    """
+    if not _is_json_schema(schema):
+        return None
+
+    if schema_digest in _validator_cache:
+        return _validator_cache[schema_digest]
+
+    try:
+        # compile genera y ejecuta código: fuera del event loop
+        validator = await asyncio.to_thread(fastjsonschema.compile, schema, handlers=_REF_HANDLERS)
+    except RemoteRefError:
+        raise HTTPException(status_code=400, detail="schema_json must not reference external schemas")
+    except Exception:
+        # Schema inválido: sin validación
+        validator = None
+
+    if len(_validator_cache) >= VALIDATOR_CACHE_MAX_SIZE:
+        del _validator_cache[next(iter(_validator_cache))]
+    _validator_cache[schema_digest] = validator
+    return validator
+
+
+def _matches_schema(validator: Optional[Callable], data) -> bool:
+    if validator is None:
+        return True
+    try:
+        validator(data)
+        return True
+    except fastjsonschema.JsonSchemaValueException:
+        return False
+
+
+def _finish_inflight(cache_key: str, task: asyncio.Task):
+    _inflight.pop(cache_key, None)
+    if not task.cancelled():
+        # marca la excepción como recuperada aunque ya no quede nadie esperando
+        task.exception()
+
+
+def _parse_json_result(result: str):
     try:
-        parsed = json.loads(result)
-        return {"success": True, "data": parsed, "tenant_id": auth["tenant_id"]}
+        # json de la stdlib: orjson convierte enteros de más de 64 bits en float
+        return json.loads(result)
     except json.JSONDecodeError:
         # Fallback: try to find JSON in the response
-        start = result.find("{")
-        end = result.rfind("}") + 1
-        if start != -1 and end > start:
-            try:
-                parsed = json.loads(result[start:end])
-                return {"success": True, "data": parsed, "tenant_id": auth["tenant_id"]}
-            except json.JSONDecodeError:
-                pass
-        return {"success": False, "data": None, "raw": result}
+        return _first_json_object(result)
+
+
+def _first_json_object(s: str) -> Optional[dict]:
+    """Devuelve el primer objeto JSON balanceado dentro de s, en una sola pasada.
+
+    Lleva la profundidad de llaves ignorando las que aparecen dentro de
+    strings (respetando escapes), así el texto extra antes o después del
+    objeto no afecta el resultado. Si un candidato no parsea, la búsqueda
+    continúa después de él, de modo que el costo total es O(n).
+    """
+    start = -1
+    depth = 0
+    in_string = False
+    escaped = False
+    for i, c in enumerate(s):
+        if start == -1:
+            # Fuera de un candidato: solo interesa la siguiente llave de apertura
+            if c == "{":
+                start, depth = i, 1
+            continue
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                try:
+                    return json.loads(s[start:i + 1])
+                except json.JSONDecodeError:
+                    # Candidato inválido: seguir en la misma pasada tras él
+                    start = -1
+    return None
+
+
+def _schema_digest(schema: dict) -> bytes:
+    return hashlib.sha256(_dumps(schema, sort_keys=True)).digest()
+
+
+def _extract_cache_key(req: ExtractRequest, schema_digest: bytes) -> str:
+    # El texto OCR se hashea tal cual (sin serializar a JSON); el schema
+    # entra por su digest canónico, ya calculado en extract
+    h = hashlib.sha256()
+    for data in (req.text.encode(), schema_digest, req.instructions.encode()):
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def _get_cached_extract(key: str):
+    entry = _extract_cache.get(key)
+    if entry is None:
+        return None
+    expiry, data = entry
+    if time.monotonic() >= expiry:
+        _extract_cache.pop(key, None)
+        return None
+    return data
+
+
+def _cache_extract(key: str, data):
+    if len(_extract_cache) >= EXTRACT_CACHE_MAX_SIZE:
+        # dict conserva orden de inserción: descarta la entrada más antigua
+        del _extract_cache[next(iter(_extract_cache))]
+    _extract_cache[key] = (time.monotonic() + EXTRACT_CACHE_TTL, data)
+
 
+@app.post("/chat", openapi_extra=_json_body(ChatRequest))
+async def chat(auth: dict = Depends(require_auth), req: ChatRequest = Depends(chat_body)):
+    """Chat libre con el modelo.
+
+    Con stream=true responde NDJSON: una línea {"response": fragmento} por
+    token generado y una final {"done": true, "tenant_id": ...}, o
+    {"error": ...} si Ollama falla a mitad del stream.
+    """
+    _check_text(req.message, "message")
+
+    if req.stream:
+        res = await _chat_stream(req.message, req.system)
+        return StreamingResponse(
+            _stream_chat_fragments(res, auth["tenant_id"]),
+            media_type="application/x-ndjson",
+        )
 
-@app.post("/chat")
-async def chat(req: ChatRequest, auth: dict = Depends(require_auth)):
-    """Chat libre con el modelo."""
     result = await _chat(req.message, req.system)
     return {"response": result, "tenant_id": auth["tenant_id"]}
 
@@ -116,45 +460,102 @@ async def _chat_structured(message: str, system: str = "", format_schema: dict =
     if format_schema:
         payload["format"] = format_schema
 
-    async with httpx.AsyncClient(timeout=120) as client:
-        try:
-            res = await client.post(
-                f"{OLLAMA_URL}/api/chat",
-                json=payload,
-            )
-            res.raise_for_status()
-            data = res.json()
-            return data["message"]["content"]
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=502, detail=f"Ollama error: {e.response.text}")
-        except Exception as e:
-            raise HTTPException(status_code=502, detail=f"Error: {str(e)}")
+    try:
+        res = await _http_client.post(
+            f"{OLLAMA_URL}/api/chat",
+            content=_dumps(payload),
+            headers={"Content-Type": "application/json"},
+        )
+        res.raise_for_status()
+        data = orjson.loads(res.content)
+        return data["message"]["content"]
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=502, detail=f"Ollama error: {e.response.text}")
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Error: {str(e)}")
 
 
-async def _chat(message: str, system: str = "") -> str:
-    """Call Ollama for free-form chat (no structured output)."""
+def _chat_payload(message: str, system: str, stream: bool) -> bytes:
     messages = []
     if system:
         messages.append({"role": "system", "content": system})
     messages.append({"role": "user", "content": message})
 
-    async with httpx.AsyncClient(timeout=120) as client:
-        try:
-            res = await client.post(
-                f"{OLLAMA_URL}/api/chat",
-                json={
-                    "model": MODEL_NAME,
-                    "messages": messages,
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.1,
-                    },
-                },
-            )
-            res.raise_for_status()
-            data = res.json()
-            return data["message"]["content"]
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=502, detail=f"Ollama error: {e.response.text}")
-        except Exception as e:
-            raise HTTPException(status_code=502, detail=f"Error: {str(e)}")
+    return orjson.dumps({
+        "model": MODEL_NAME,
+        "messages": messages,
+        "stream": stream,
+        "options": {
+            "temperature": 0.1,
+        },
+    })
+
+
+async def _chat(message: str, system: str = "") -> str:
+    """Call Ollama for free-form chat (no structured output)."""
+    try:
+        res = await _http_client.post(
+            f"{OLLAMA_URL}/api/chat",
+            content=_chat_payload(message, system, stream=False),
+            headers={"Content-Type": "application/json"},
+        )
+        res.raise_for_status()
+        data = orjson.loads(res.content)
+        return data["message"]["content"]
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=502, detail=f"Ollama error: {e.response.text}")
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Error: {str(e)}")
+
+
+async def _chat_stream(message: str, system: str = "") -> httpx.Response:
+    """Open a streaming free-form chat against Ollama.
+
+    The status is checked before returning so errors still map to a 502;
+    the caller owns the response and must close it.
+    """
+    request = _http_client.build_request(
+        "POST",
+        f"{OLLAMA_URL}/api/chat",
+        content=_chat_payload(message, system, stream=True),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        res = await _http_client.send(request, stream=True)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Error: {str(e)}")
+
+    if res.is_error:
+        await res.aread()
+        await res.aclose()
+        raise HTTPException(status_code=502, detail=f"Ollama error: {res.text}")
+    return res
+
+
+async def _stream_chat_fragments(res: httpx.Response, tenant_id: str) -> AsyncIterator[bytes]:
+    """Relay Ollama's NDJSON stream.
+
+    The status code is already sent, so failures mid-stream are reported as
+    a final {"error": ...} line instead of {"done": true}.
+    """
+    try:
+        async for line in res.aiter_lines():
+            if not line:
+                continue
+            data = orjson.loads(line)
+            if "error" in data:
+                yield orjson.dumps({"error": f"Ollama error: {data['error']}"}) + b"\n"
+                return
+            content = data.get("message", {}).get("content", "")
+            if content:
+                yield orjson.dumps({"response": content}) + b"\n"
+            if data.get("done"):
+                yield orjson.dumps({"done": True, "tenant_id": tenant_id}) + b"\n"
+                return
+        yield orjson.dumps({"error": "Ollama stream ended before completion"}) + b"\n"
+    except orjson.JSONDecodeError as e:
+        yield orjson.dumps({"error": f"Invalid Ollama stream line: {e}"}) + b"\n"
+    except httpx.HTTPError as e:
+        yield orjson.dumps({"error": f"Error: {str(e)}"}) + b"\n"
+    finally:
+        await res.aclose()
@@ -0,0 +1,10 @@
+-- Índices parciales para las consultas de validación de app/auth.py.
+-- Ejecutar contra la BD de api_warocol (CONCURRENTLY no admite transacción).
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_api_tokens_key_hash_active
+    ON api_tokens (key_hash)
+    WHERE is_active = true;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sessions_id_active
+    ON sessions (id)
+    WHERE is_active = true;